@@ -1,100 +1,249 @@
-from thefuzz import fuzz
-from thefuzz import process
+from rapidfuzz import fuzz
+from rapidfuzz import process
+from rapidfuzz import utils
+import numpy as np
 import pandas as pd
-from snowflake.connector import connect, ProgrammingError
-from snowflake.connector.pandas_tools import write_pandas
-import names
-from dotenv import load_dotenv
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pv
+import pyarrow.parquet as pq
 import os
-import seaborn
-
-def load_data(csv_path = './data') -> tuple[pd.DataFrame, pd.DataFrame, dict[str, pd.DataFrame]]:
+import tempfile
+from collections.abc import Sequence
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+# Column types of the csv data
+TRANSACTIONS_SCHEMA = {
+    'transaction_id': pa.int64(),
+    'customer_name': pa.string(),
+    'amount': pa.int64(),
+    'transaction_date': pa.date32(),
+}
+CUSTOMERS_SCHEMA = {
+    'customer_id': pa.int64(),
+    'customer_name': pa.string(),
+    'email': pa.string(),
+}
+
+# Minimum number of names scored by each thread when scoring in parallel chunks
+MIN_CHUNK_SIZE = 256
+
+# Pre-baked reference name files (stored alongside the csv data) for each list of the module "names"
+REFERENCE_FILES = {
+    'first:female': 'first_female.parquet',
+    'first:male': 'first_male.parquet',
+    'last': 'last.parquet',
+}
+
+def build_reference_names(csv_path: str = './data') -> None:
     """
-    Load transaction, customer and name data.
-    
-    Args:
-        csv_path (str, optional): Path to the stored data. Defaults to './data'
+    Parse the most common names from the US Census and store them as parquet files, so they are not parsed on every run.
 
-    Returns:
-        tuple: A tuple containing the transactions dataframe, the customers dataframe and the reference names dictionary.
+    Args:
+        csv_path (str, optional): Path to the stored data, where the parquet files will be written. Defaults to './data'.
     """
+    import names
 
-    # Reading data from csv
-    transactions = pd.read_csv(f'{csv_path}/transactions.csv')
-    customers = pd.read_csv(f'{csv_path}/customers.csv')
-
-    # Getting most common names from the US Census (public data)
-    # It is fetched through the module "names" and stored in the package data
-    reference_names = {}
+    # The names are fetched through the module "names" and stored in the package data
     for key, path in names.FILES.items():
         column_names = ['name', 'pct', 'sum_pct', 'position']
 
+        # Only the name column is used, and the whitespace separator is handled by the C parser
         df = pd.read_csv(
             path,
             sep=r'\s+',
-            names=column_names, 
+            names=column_names,
+            usecols=['name'],
             nrows=1000,
+            engine='c',
         )
-        reference_names[key] = df
-    
-    return transactions, customers, reference_names
+        table = pa.table({'name': pa.array(df['name'].tolist(), type=pa.string())})
+        pq.write_table(table, f'{csv_path}/{REFERENCE_FILES[key]}')
 
-def get_best_score(name: str, choices: list[str]) -> int:
+@lru_cache(maxsize=4)
+def read_reference_names(data_path: str, modified_times: tuple[float, ...]) -> tuple[tuple[str, ...], tuple[str, ...]]:
     """
-    Find the best score for a match between the name and the choices.
+    Read the reference names parquet files, cached by absolute path and file modification times (see load_reference_names).
 
     Args:
-        name (str): The name to be matched against the choices.
-        choices (list[str]): A list with the possible choices to match the name to.
+        data_path (str): Absolute path to the stored data.
+        modified_times (tuple[float, ...]): Modification times of the parquet files, so rebuilt files are read again.
 
     Returns:
-        int: The biggest score.
+        tuple: A tuple containing the first names (female and male) and the last names, as immutable tuples.
+    """
+    reference_names = {}
+    for key, file_name in REFERENCE_FILES.items():
+        reference_names[key] = pq.read_table(os.path.join(data_path, file_name), memory_map=True).column('name').to_pylist()
+
+    return tuple(reference_names['first:female'] + reference_names['first:male']), tuple(reference_names['last'])
+
+def load_reference_names(csv_path: str = './data') -> tuple[tuple[str, ...], tuple[str, ...]]:
     """
-    best, score = process.extractOne(name, choices, scorer=fuzz.token_set_ratio)
-    return score
+    Load the most common first and last names from the US Census, only reading the files again if they changed.
 
-def extract_best(name: str, choices: list[str], threshold: int = 75) -> str | None:
+    Args:
+        csv_path (str, optional): Path to the stored data. Defaults to './data'.
+
+    Returns:
+        tuple: A tuple containing the first names (female and male) and the last names, as immutable tuples.
     """
-    Wrapper for the extractOne function which allows it to be called from apply.
+
+    # Building the parquet files on the first run
+    if not all(os.path.exists(f'{csv_path}/{file_name}') for file_name in REFERENCE_FILES.values()):
+        build_reference_names(csv_path)
+
+    # Keying the cache on the absolute path (so a change of working directory isn't served stale names) and the file times
+    data_path = os.path.abspath(csv_path)
+    modified_times = tuple(os.path.getmtime(os.path.join(data_path, file_name)) for file_name in REFERENCE_FILES.values())
+    return read_reference_names(data_path, modified_times)
+
+def load_data(csv_path = './data') -> tuple[pd.DataFrame, pd.DataFrame, tuple[tuple[str, ...], tuple[str, ...]]]:
+    """
+    Load transaction, customer and name data.
     
     Args:
-        name (str): The name to be matched against the choices.
-        choices (list[str]): A list with the possible choices to match the name to.
-        threshold (int, optional): The threshold to filter the results by (inclusive).
+        csv_path (str, optional): Path to the stored data. Defaults to './data'
 
     Returns:
-        Optional[str]: The best match, if there's one with score bigger than the threshold.
+        tuple: A tuple containing the transactions dataframe, the customers dataframe and the reference first and last names.
     """
-    result = process.extractOne(name, choices, scorer=fuzz.token_set_ratio, score_cutoff=threshold)
-    if result is not None:
-        return result[0]
-    return None
 
-def select_best_full_name(row: pd.Series) -> str:
+    # Reading data from csv with the multithreaded pyarrow reader, keeping the columns Arrow-backed
+    transactions = pv.read_csv(
+        f'{csv_path}/transactions.csv',
+        convert_options=pv.ConvertOptions(column_types=TRANSACTIONS_SCHEMA),
+    ).to_pandas(types_mapper=pd.ArrowDtype)
+    customers = pv.read_csv(
+        f'{csv_path}/customers.csv',
+        convert_options=pv.ConvertOptions(column_types=CUSTOMERS_SCHEMA),
+    ).to_pandas(types_mapper=pd.ArrowDtype)
+
+    # Getting most common names from the US Census (public data)
+    reference_names = load_reference_names(csv_path)
+    
+    return transactions, customers, reference_names
+
+def preprocess_names(names: Sequence[str]) -> list[str]:
     """
-    Find the most probable full name using the scores columns.
+    Normalize the names (lowercase, without punctuation or surrounding whitespace) once, instead of on every comparison.
 
     Args:
-        row (pd.Series): A pandas Series with the columns customer_name_1, customer_name_2, score_1, score_2, score_last_1, score_last_2.
+        names (Sequence[str]): The names to be normalized.
 
     Returns:
-        str: The most probable full name.
+        list[str]: The normalized names, in the same order.
+    """
+    return [utils.default_process(name) for name in names]
+
+@lru_cache(maxsize=8)
+def preprocess_choices(choices: tuple[str, ...]) -> tuple[tuple[str, ...], frozenset[str]]:
     """
-    if row['score_1'] > row['score_2']:
-        best_first = row['customer_name_1'].split(' ')[0]
-    elif row['score_2'] > row['score_1']:
-        best_first = row['customer_name_2'].split(' ')[0]
-    else:
-        best_first = row['customer_name_1'].split(' ')[0]
+    Normalize a tuple of reference choices, cached so the reference names are only normalized once per process.
+    Only meant for the fixed reference lists (see get_best_score), data-dependent choices should use preprocess_names.
+
+    Args:
+        choices (tuple[str, ...]): The choices to be normalized.
 
-    if row['score_last_1'] > row['score_last_2']:
-        best_last = row['customer_name_1'].split(' ')[1]
-    elif row['score_last_2'] > row['score_last_1']:
-        best_last = row['customer_name_2'].split(' ')[1]
-    else:
-        best_last = row['customer_name_1'].split(' ')[1]
+    Returns:
+        tuple: A tuple containing the normalized choices, in the same order, and a set of them for exact lookups.
+    """
+    processed_choices = tuple(preprocess_names(choices))
+    return processed_choices, frozenset(processed_choices)
+
+def score_choices(
+    names: list[str],
+    choices: Sequence[str],
+    score_cutoff: int | None = None,
+    workers: int = -1,
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Find the best choice for each name, scoring every choice with token_set_ratio.
+    Both the names and the choices are expected to be already preprocessed (see preprocess_names).
 
-    return f"{best_first} {best_last}"
+    Args:
+        names (list[str]): The preprocessed names to be matched against the choices.
+        choices (Sequence[str]): A list or tuple with the preprocessed choices to match the names to.
+        score_cutoff (int, optional): Scores below this value are set to 0. Defaults to None.
+        workers (int, optional): Number of threads used to compute the scores, -1 uses all the cores. Defaults to -1.
+
+    Returns:
+        tuple: A tuple containing the index of the best choice and its score for each name.
+    """
+    # Scoring chunks of names in parallel threads (RapidFuzz releases the GIL), each chunk running on a single core
+    # Inputs too small to fill at least two chunks are scored by a single call instead
+    n_workers = (os.cpu_count() or 1) if workers == -1 else workers
+    n_chunks = min(n_workers, len(names) // MIN_CHUNK_SIZE)
+    if n_chunks > 1:
+        chunks = np.array_split(np.asarray(names, dtype=object), n_chunks)
+        with ThreadPoolExecutor(max_workers=n_chunks) as executor:
+            results = list(executor.map(
+                lambda chunk: score_choices(chunk.tolist(), choices, score_cutoff, workers=1),
+                chunks,
+            ))
+        return np.concatenate([index for index, _ in results]), np.concatenate([score for _, score in results])
+
+    scores = process.cdist(
+        names,
+        choices,
+        scorer=fuzz.token_set_ratio,
+        processor=None,
+        dtype=np.uint8,
+        score_cutoff=score_cutoff,
+        workers=workers,
+    )
+    return scores.argmax(axis=1), scores.max(axis=1)
+
+def get_best_score(
+    names: list[str],
+    choices: Sequence[str],
+    workers: int = -1,
+) -> np.ndarray:
+    """
+    Find the best score for a match between each name and the choices.
+
+    Args:
+        names (list[str]): The names to be matched against the choices.
+        choices (Sequence[str]): A list or tuple with the possible choices to match the names to.
+        workers (int, optional): Number of threads used to compute the scores, -1 uses all the cores. Defaults to -1.
+
+    Returns:
+        np.ndarray: The biggest score for each name.
+    """
+    processed_names = preprocess_names(names)
+    processed_choices, choices_set = preprocess_choices(tuple(choices))
+
+    # Names found as they are in the choices (most of the Census hits) get the perfect score from a hash lookup
+    exact_mask = np.array([name in choices_set for name in processed_names], dtype=bool)
+    best_score = np.full(len(processed_names), 100, dtype=np.uint8)
+
+    # Only the remaining names go through the fuzzy scoring
+    fuzzy_names = [name for name, exact in zip(processed_names, exact_mask) if not exact]
+    _, fuzzy_score = score_choices(fuzzy_names, processed_choices, workers=workers)
+    best_score[~exact_mask] = fuzzy_score
+    return best_score
+
+def extract_best(
+    names: list[str],
+    choices: Sequence[str],
+    threshold: int = 75,
+    workers: int = -1,
+) -> list[str | None]:
+    """
+    Find the best match for each name among the choices.
+    
+    Args:
+        names (list[str]): The names to be matched against the choices.
+        choices (Sequence[str]): A list or tuple with the possible choices to match the names to.
+        threshold (int, optional): The threshold to filter the results by (inclusive).
+        workers (int, optional): Number of threads used to compute the scores, -1 uses all the cores. Defaults to -1.
+
+    Returns:
+        list[Optional[str]]: The best match for each name, if there's one with score bigger than the threshold.
+    """
+    best_index, best_score = score_choices(preprocess_names(names), preprocess_names(choices), threshold, workers)
+    return [choices[index] if score >= threshold else None for index, score in zip(best_index, best_score)]
 
 def connect_to_snowflake(verbose: bool =True):
     """
@@ -106,6 +255,9 @@ def connect_to_snowflake(verbose: bool =True):
     Returns:
         Optional[SnowflakeConnection]: The connection to the snowflake database.
     """
+    from dotenv import load_dotenv
+    from snowflake.connector import connect, ProgrammingError
+
     load_dotenv()
 
     SNOWFLAKE_ACCOUNT = os.getenv('SNOWFLAKE_ACCOUNT')
@@ -166,6 +318,54 @@ def create_table(conn, table_name: str, verbose: str = False) -> bool:
             print(f"Failed to create table '{table_name}': {e}")
         return False
     
+def upload_dataframe(conn, df: pd.DataFrame, table_name: str, verbose: bool = False) -> bool:
+    """
+    Uploads a dataframe to a table in the connected Snowflake database, staging it as a single parquet file.
+
+    Args:
+        conn: The Snowflake connection object.
+        df (pd.DataFrame): The dataframe to upload, with column names matching the table columns.
+        table_name (str): The name of the table to load the data into.
+        verbose (bool, optional): Set to true to display more information about the execution. Defaults to False.
+
+    Returns:
+        bool: True if the data was uploaded successfully, False otherwise.
+    """
+
+    try:
+        with tempfile.TemporaryDirectory() as temp_dir, conn.cursor() as cursor:
+            # Writing the (Arrow-backed) dataframe straight to a snappy compressed parquet file
+            file_path = os.path.join(temp_dir, f'{table_name.lower()}.parquet').replace('\\', '/')
+            pq.write_table(pa.Table.from_pandas(df, preserve_index=False), file_path, compression='snappy')
+
+            # Staging the file in the table stage and loading it into the table
+            cursor.execute(f"PUT 'file://{file_path}' @%{table_name} AUTO_COMPRESS=FALSE OVERWRITE=TRUE")
+            cursor.execute(f"""
+            COPY INTO {table_name}
+            FROM @%{table_name}
+            FILE_FORMAT = (TYPE = PARQUET)
+            MATCH_BY_COLUMN_NAME = CASE_INSENSITIVE
+            PURGE = TRUE
+            """)
+            # Reading the loaded rows by column name, when no file is processed only a single status column is returned
+            columns = [column[0].lower() for column in cursor.description]
+            results = cursor.fetchall()
+            if 'rows_loaded' not in columns:
+                if verbose:
+                    status = results[0][0] if results else 'no files were processed'
+                    print(f"No data was loaded into {table_name}: {status}")
+                return False
+
+            rows_loaded = columns.index('rows_loaded')
+            nrows = sum(row[rows_loaded] for row in results)
+            if verbose:
+                print(f"Successfully uploaded {nrows} rows to {table_name}.")
+            return True
+    except Exception as e:
+        if verbose:
+            print(f"Failed to upload DataFrame to Snowflake: {e}")
+        return False
+
 def main(csv_path: str = './data', table_name: str = 'CUSTOMER_TRANSACTIONS', verbose: bool = True) -> None:
     """
     Loads the csv data, matches it and loads to a Snowflake database.
@@ -175,15 +375,28 @@ def main(csv_path: str = './data', table_name: str = 'CUSTOMER_TRANSACTIONS', ve
         table_name (str, optional): Name to the new table (uppercase). Defaults to 'CUSTOMER_TRANSACTIONS'.
         verbose (bool, optional): Set to true to display more information about the execution. Defaults to True.
     """
-
     table_name = table_name.upper()
 
     # Loading data from csv and module files
     transactions, customers, reference_names = load_data(csv_path)
 
-    # Matching the customer_names from both dataframes using fuzzy matching
+    # Matching the customer_names from both dataframes using fuzzy matching (each distinct name is matched only once)
+    # Names already present in the customers are matched directly, only the remaining ones go through the fuzzy matching
     customers_names = customers['customer_name'].tolist()
-    transactions['external_name'] = transactions['customer_name'].apply(lambda name: extract_best(name, customers_names))
+    unique_names = transactions['customer_name'].drop_duplicates()
+    exact_mask = unique_names.isin(set(customers_names))
+    exact_names = unique_names[exact_mask]
+    fuzzy_names = unique_names[~exact_mask]
+    name_matches = pd.concat([
+        pd.Series(exact_names.tolist(), index=exact_names, dtype=object),
+        pd.Series(extract_best(fuzzy_names.tolist(), customers_names), index=fuzzy_names, dtype=object),
+    ])
+    transactions['external_name'] = transactions['customer_name'].map(name_matches)
+
+    # Encoding both join keys with the same categories (every match is a customer name), so the merge is done on integer codes
+    join_keys = pd.CategoricalDtype(customers['customer_name'].dropna().unique())
+    transactions['external_name'] = transactions['external_name'].astype(join_keys)
+    customers['customer_name'] = customers['customer_name'].astype(join_keys)
 
     # Merging the two dataframes
     merged_df = pd.merge(
@@ -195,42 +408,66 @@ def main(csv_path: str = './data', table_name: str = 'CUSTOMER_TRANSACTIONS', ve
         suffixes=('_1', '_2')
     )
 
-    # Turning any None (in this case it would be a transaction without a matching customer name) into " " so that it can be parsed by the next step
-    merged_df = merged_df.fillna(' ')
-
     # Removing duplicate column
     merged_df.drop(columns=['external_name'], inplace=True)
 
-    # Scoring the names based on the reference list to get the most probable full name
-    merged_df['score_1'] = merged_df['customer_name_1'].apply(lambda name: get_best_score(name.split(' ')[0], reference_names['first:female']['name'].to_list()+reference_names['first:male']['name'].to_list()))
-    merged_df['score_2'] = merged_df['customer_name_2'].apply(lambda name: get_best_score(name.split(' ')[0], reference_names['first:female']['name'].to_list()+reference_names['first:male']['name'].to_list()))
-    merged_df['score_last_1'] = merged_df['customer_name_1'].apply(lambda name: get_best_score(name.split(' ')[1], reference_names['last']['name'].to_list()))
-    merged_df['score_last_2'] = merged_df['customer_name_2'].apply(lambda name: get_best_score(name.split(' ')[1], reference_names['last']['name'].to_list()))
-    merged_df['customer_name'] = merged_df.apply(lambda row: select_best_full_name(row), axis=1)
+    # Splitting both customer names into first and last names once, to be reused by the scoring and the selection
+    # Missing parts (a transaction without a matching customer name, or a name without a last name) become empty strings
+    split_1 = merged_df['customer_name_1'].str.split(' ', n=1, expand=True).reindex(columns=[0, 1]).fillna('')
+    split_2 = merged_df['customer_name_2'].str.split(' ', n=1, expand=True).reindex(columns=[0, 1]).fillna('')
+    first_name_1, last_name_1 = split_1[0], split_1[1]
+    first_name_2, last_name_2 = split_2[0], split_2[1]
+
+    # The reference choices are immutable tuples, cached (with their normalized form) between runs
+    FIRST_REF, LAST_REF = reference_names
+
+    # Scoring the names based on the reference list to get the most probable full name (each distinct name is scored only once)
+    unique_first = pd.concat([first_name_1, first_name_2]).drop_duplicates()
+    first_scores = pd.Series(get_best_score(unique_first.tolist(), FIRST_REF), index=unique_first)
+    unique_last = pd.concat([last_name_1, last_name_2]).drop_duplicates()
+    last_scores = pd.Series(get_best_score(unique_last.tolist(), LAST_REF), index=unique_last)
+
+    merged_df['score_1'] = first_name_1.map(first_scores)
+    merged_df['score_2'] = first_name_2.map(first_scores)
+    merged_df['score_last_1'] = last_name_1.map(last_scores)
+    merged_df['score_last_2'] = last_name_2.map(last_scores)
+
+    # Selecting the most probable full name, keeping the first customer name on ties
+    # Both the first and the last names are picked by a single gather over the (source, row, part) array of name parts
+    name_parts = np.stack([split_1.to_numpy(dtype=object), split_2.to_numpy(dtype=object)])
+    pick = np.stack([
+        merged_df['score_2'].to_numpy() > merged_df['score_1'].to_numpy(),
+        merged_df['score_last_2'].to_numpy() > merged_df['score_last_1'].to_numpy(),
+    ], axis=1).astype(np.int8)
+    best_parts = name_parts[pick, np.arange(len(merged_df))[:, None], [0, 1]]
+    full_names = pc.binary_join_element_wise(
+        pa.array(best_parts[:, 0], type=pa.string()),
+        pa.array(best_parts[:, 1], type=pa.string()),
+        ' ',
+    )
+    merged_df['customer_name'] = pd.Series(full_names, index=merged_df.index, dtype=pd.ArrowDtype(pa.string()))
     merged_df.drop(columns=['customer_name_1', 'customer_name_2', 'score_1', 'score_2', 'score_last_1', 'score_last_2'], inplace=True)
 
     # Preparing the column names to allow it to be uploaded to snowflake
-    merged_df.columns = [str.upper(column_name) for column_name in merged_df.columns]
+    merged_df.columns = merged_df.columns.str.upper()
 
     # Connecting to snowflake using the environment variables
     conn = connect_to_snowflake(verbose)
+    if conn is None:
+        return
 
-    # Creating a new table (or replacing an existing one)
-    create_table(conn, table_name, verbose)
-
-    # Uploading data to the new table on snowflake
-    success, nchunks, nrows, _ = write_pandas(conn, merged_df, table_name)
-    if success:
-        if verbose:
-            print(f"Successfully uploaded {nrows} rows to {table_name} in {nchunks} chunks.")
-    else:
+    try:
+        # Creating a new table (or replacing an existing one), there's nothing to upload to if it fails
+        if not create_table(conn, table_name, verbose):
+            return
+
+        # Uploading data to the new table on snowflake
+        upload_dataframe(conn, merged_df, table_name, verbose)
+    finally:
+        # Closing the connection, even if the upload failed
+        conn.close()
         if verbose:
-            print("Failed to upload DataFrame to Snowflake.")
-
-    # Closing the connection
-    conn.close()
-    if verbose:
-        print("Connection to Snowflake closed successfully.")
+            print("Connection to Snowflake closed successfully.")
 
 if __name__ == '__main__':
     main()
\ No newline at end of file